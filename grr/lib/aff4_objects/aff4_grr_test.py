@@ -2,7 +2,7 @@
 # Copyright 2011 Google Inc. All Rights Reserved.
 """Test the grr aff4 objects."""
 
-import time
+import itertools
 
 from grr.lib import action_mocks
 from grr.lib import aff4
@@ -10,13 +10,44 @@ from grr.lib import flags
 from grr.lib import flow
 from grr.lib import rdfvalue
 from grr.lib import test_lib
-from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
 
 
+_OS = rdf_paths.PathSpec.PathType.OS
+_TSK = rdf_paths.PathSpec.PathType.TSK
+
+# Pathspecs used by testPathspecToURN and the URNs they should map to. These
+# are only parsed once per process.
+_VOLUME_PATHSPEC = rdf_paths.PathSpec(path="\\\\.\\Volume{1234}\\",
+                                      pathtype=_OS,
+                                      mount_point="/c:/").Append(
+                                          path="/windows", pathtype=_TSK)
+
+_EXPECTED_VOLUME_URN = rdfvalue.RDFURN(
+    r"aff4:/C.1234567812345678/fs/tsk/\\.\Volume{1234}\/windows")
+
+_ADS_PATHSPEC = rdf_paths.PathSpec(path="\\\\.\\Volume{1234}\\",
+                                   pathtype=_OS,
+                                   mount_point="/c:/").Append(
+                                       pathtype=_TSK,
+                                       path="/Test Directory/notes.txt:ads",
+                                       inode=66,
+                                       ntfs_type=128,
+                                       ntfs_id=2)
+
+_EXPECTED_ADS_URN = rdfvalue.RDFURN(
+    r"aff4:/C.1234567812345678/fs/tsk/\\.\Volume{1234}\/"
+    "Test Directory/notes.txt:ads")
+
+
+def _CountUpTo(iterable, limit):
+  """Counts the items in iterable, consuming at most limit items."""
+  return len(list(itertools.islice(iterable, limit)))
+
+
 class MockChangeEvent(flow.EventListener):
   EVENTS = ["MockChangeEvent"]
 
@@ -24,14 +55,16 @@ class MockChangeEvent(flow.EventListener):
 
   CHANGED_URNS = []
 
+  _AUTHED = rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
+
   @flow.EventHandler(allow_client_access=True)
   def ProcessMessage(self, message=None, event=None):
-    _ = event
-    if (message.auth_state !=
-        rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED):
+    if message.auth_state != self._AUTHED:
       return
 
-    urn = rdfvalue.RDFURN(message.payload)
+    # The EventHandler decorator has already decoded the payload into event,
+    # so we don't decode message.payload a second time.
+    urn = rdfvalue.RDFURN(event)
     MockChangeEvent.CHANGED_URNS.append(urn)
 
 
@@ -42,45 +75,32 @@ class AFF4GRRTest(test_lib.AFF4ObjectTest):
     super(AFF4GRRTest, self).setUp()
     MockChangeEvent.CHANGED_URNS = []
 
+  def _SetupClientWithFixture(self):
+    """Creates a single client populated with the standard VFS fixture."""
+    client_id = self.SetupClients(1)[0]
+    test_lib.ClientFixture(client_id, token=self.token)
+    return client_id
+
   def testPathspecToURN(self):
     """Test the pathspec to URN conversion function."""
-    pathspec = rdf_paths.PathSpec(path="\\\\.\\Volume{1234}\\",
-                                  pathtype=rdf_paths.PathSpec.PathType.OS,
-                                  mount_point="/c:/").Append(
-                                      path="/windows",
-                                      pathtype=rdf_paths.PathSpec.PathType.TSK)
-
-    urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(pathspec,
+    urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(_VOLUME_PATHSPEC.Copy(),
                                                      "C.1234567812345678")
-    self.assertEqual(urn, rdfvalue.RDFURN(
-        r"aff4:/C.1234567812345678/fs/tsk/\\.\Volume{1234}\/windows"))
+    self.assertEqual(urn, _EXPECTED_VOLUME_URN)
 
     # Test an ADS
-    pathspec = rdf_paths.PathSpec(path="\\\\.\\Volume{1234}\\",
-                                  pathtype=rdf_paths.PathSpec.PathType.OS,
-                                  mount_point="/c:/").Append(
-                                      pathtype=rdf_paths.PathSpec.PathType.TSK,
-                                      path="/Test Directory/notes.txt:ads",
-                                      inode=66,
-                                      ntfs_type=128,
-                                      ntfs_id=2)
-
-    urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(pathspec,
+    urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(_ADS_PATHSPEC.Copy(),
                                                      "C.1234567812345678")
-    self.assertEqual(urn, rdfvalue.RDFURN(
-        r"aff4:/C.1234567812345678/fs/tsk/\\.\Volume{1234}\/"
-        "Test Directory/notes.txt:ads"))
+    self.assertEqual(urn, _EXPECTED_ADS_URN)
 
   def testClientSubfieldGet(self):
     """Test we can get subfields of the client."""
-    fd = aff4.FACTORY.Create("C.0000000000000000",
+    fd = aff4.FACTORY.Create(self.client_id,
                              aff4_grr.VFSGRRClient,
                              token=self.token,
                              age=aff4.ALL_TIMES)
 
     kb = fd.Schema.KNOWLEDGE_BASE()
-    for i in range(5):
-      kb.users.Append(rdf_client.User(username="user%s" % i))
+    kb.users.Extend([rdf_client.User(username="user%s" % i) for i in range(5)])
     fd.Set(kb)
     fd.Close()
 
@@ -88,58 +108,77 @@ class AFF4GRRTest(test_lib.AFF4ObjectTest):
         "KnowledgeBase.users").next()):
       self.assertEqual(user.username, "user%s" % i)
 
-  def testVFSFileContentLastNotUpdated(self):
-    """Make sure CONTENT_LAST does not update when only STAT is written.."""
-    path = "/C.12345/contentlastchecker"
+  def _CheckContentLastNotUpdated(self, num_writes, flush_every_write):
+    """Make sure CONTENT_LAST does not update when only STAT is written.
 
-    timestamp = 1
-    with utils.Stubber(time, "time", lambda: timestamp):
+    Args:
+      num_writes: The number of small writes to make to the file.
+      flush_every_write: If True, the file is flushed after every write,
+        otherwise it is only flushed once all writes are done.
+    """
+    path = self.client_id.Add("contentlastchecker")
+
+    with test_lib.FakeTime(1) as clock:
       fd = aff4.FACTORY.Create(path,
                                aff4_grr.VFSFile,
                                mode="w",
                                token=self.token)
 
-      timestamp += 1
+      clock.time += 1
       fd.SetChunksize(10)
 
       # Make lots of small writes - The length of this string and the chunk size
       # are relative primes for worst case.
-      for i in range(100):
-        fd.Write("%s%08X\n" % ("Test", i))
+      payloads = ["Test%08X\n" % i for i in range(num_writes)]
+      for payload in payloads:
+        fd.Write(payload)
 
-        # Flush after every write.
-        fd.Flush()
+        if flush_every_write:
+          fd.Flush()
 
         # And advance the time.
-        timestamp += 1
+        clock.time += 1
 
       fd.Set(fd.Schema.STAT, rdf_client.StatEntry())
 
       fd.Close()
 
+    # The last write happened at time num_writes + 1.
+    expected_content_age = (num_writes + 1) * 1000000
+
+    # Reopening once checks that CONTENT_LAST was persisted when the writes
+    # occurred. Flush() keeps the object valid, so the rest of the checks can be
+    # made on the same handle.
     fd = aff4.FACTORY.Open(path, mode="rw", token=self.token)
-    # Make sure the attribute was written when the write occured.
-    self.assertEqual(int(fd.GetContentAge()), 101000000)
+    # Make sure the attribute was written when the write occurred.
+    self.assertEqual(int(fd.GetContentAge()), expected_content_age)
 
     # Write the stat (to be the same as before, but this still counts
     # as a write).
     fd.Set(fd.Schema.STAT, fd.Get(fd.Schema.STAT))
     fd.Flush()
 
-    fd = aff4.FACTORY.Open(path, token=self.token)
-
     # The age of the content should still be the same.
-    self.assertEqual(int(fd.GetContentAge()), 101000000)
+    self.assertEqual(int(fd.GetContentAge()), expected_content_age)
+    self.assertEqual(int(fd.Get(fd.Schema.CONTENT_LAST)), expected_content_age)
+
+  def testVFSFileContentLastNotUpdated(self):
+    """Make sure CONTENT_LAST does not update when only STAT is written.."""
+    self._CheckContentLastNotUpdated(100, flush_every_write=False)
+
+  def testVFSFileContentLastNotUpdatedWithFlushes(self):
+    """CONTENT_LAST should be kept correctly when flushing after each write."""
+    self._CheckContentLastNotUpdated(3, flush_every_write=True)
 
   def testVFSFileStartsOnlyOneMultiGetFileFlowOnUpdate(self):
     """File updates should only start one MultiGetFile at any point in time."""
-    client_id = self.SetupClients(1)[0]
-    test_lib.ClientFixture(client_id, token=self.token)
+    client_id = self._SetupClientWithFixture()
+    flows_urn = client_id.Add("flows")
     # We need to choose a file path having a pathsepc.
-    path = "fs/os/c/bin/bash"
+    file_urn = client_id.Add("fs/os/c/bin/bash")
 
     with aff4.FACTORY.Create(
-        client_id.Add(path),
+        file_urn,
         aff4_type=aff4_grr.VFSFile,
         mode="rw",
         token=self.token) as file_fd:
@@ -147,7 +186,7 @@ class AFF4GRRTest(test_lib.AFF4ObjectTest):
       file_fd.Update()
 
     # Check that there is exactly one flow on the client.
-    flows_fd = aff4.FACTORY.Open(client_id.Add("flows"), token=self.token)
+    flows_fd = aff4.FACTORY.Open(flows_urn, token=self.token)
     flows = list(flows_fd.ListChildren())
     self.assertEqual(len(flows), 1)
 
@@ -160,20 +199,19 @@ class AFF4GRRTest(test_lib.AFF4ObjectTest):
     # this call shouldn't do anything.
     file_fd.Update()
 
-    # There should still be only one flow on the client.
-    flows_fd = aff4.FACTORY.Open(client_id.Add("flows"), token=self.token)
-    flows = list(flows_fd.ListChildren())
-    self.assertEqual(len(flows), 1)
+    # There should still be only one flow on the client. ListChildren()
+    # queries the data store each time, so there is no need to reopen flows_fd.
+    self.assertEqual(_CountUpTo(flows_fd.ListChildren(), 2), 1)
 
   def testVFSFileStartsNewMultiGetFileWhenLockingFlowHasFinished(self):
     """A new MultiFileGet can be started when the locking flow has finished."""
-    client_id = self.SetupClients(1)[0]
-    test_lib.ClientFixture(client_id, token=self.token)
+    client_id = self._SetupClientWithFixture()
+    flows_urn = client_id.Add("flows")
     # We need to choose a file path having a pathsepc.
-    path = "fs/os/c/bin/bash"
+    file_urn = client_id.Add("fs/os/c/bin/bash")
 
     with aff4.FACTORY.Create(
-        client_id.Add(path),
+        file_urn,
         aff4_type=aff4_grr.VFSFile,
         mode="rw",
         token=self.token) as file_fd:
@@ -181,7 +219,7 @@ class AFF4GRRTest(test_lib.AFF4ObjectTest):
       first_update_flow_urn = file_fd.Update()
 
     # Check that there is exactly one flow on the client.
-    flows_fd = aff4.FACTORY.Open(client_id.Add("flows"), token=self.token)
+    flows_fd = aff4.FACTORY.Open(flows_urn, token=self.token)
     flows = list(flows_fd.ListChildren())
     self.assertEqual(len(flows), 1)
 
@@ -198,9 +236,7 @@ class AFF4GRRTest(test_lib.AFF4ObjectTest):
     second_update_flow_urn = file_fd.Update()
 
     # There should be two flows now.
-    flows_fd = aff4.FACTORY.Open(client_id.Add("flows"), token=self.token)
-    flows = list(flows_fd.ListChildren())
-    self.assertEqual(len(flows), 2)
+    self.assertEqual(_CountUpTo(flows_fd.ListChildren(), 3), 2)
 
     # Make sure that each Update() started a new flow and that the second flow
     # is holding the lock.
@@ -220,22 +256,22 @@ class AFF4GRRTest(test_lib.AFF4ObjectTest):
     userobj = rdf_client.User(username=user)
     interface = rdf_client.Interface(ifname="eth0")
 
-    timestamp = 1
-    with utils.Stubber(time, "time", lambda: timestamp):
-      with aff4.FACTORY.Create("C.0000000000000000",
+    with test_lib.FakeTime(1) as clock:
+      with aff4.FACTORY.Create(self.client_id,
                                aff4_grr.VFSGRRClient,
                                mode="rw",
                                token=self.token) as fd:
         kb = rdf_client.KnowledgeBase()
         kb.users.Append(userobj)
         empty_summary = fd.GetSummary()
-        self.assertEqual(empty_summary.client_id, "C.0000000000000000")
+        self.assertEqual(empty_summary.client_id, self.client_id)
         self.assertFalse(empty_summary.system_info.version)
         self.assertEqual(empty_summary.timestamp.AsSecondsFromEpoch(), 1)
 
         # This will cause TYPE to be written with current time = 101 when the
-        # object is closed
-        timestamp += 100
+        # object is closed. The attributes below are only buffered by Set() and
+        # get written to the data store in a single batch on close.
+        clock.time += 100
         fd.Set(fd.Schema.HOSTNAME(hostname))
         fd.Set(fd.Schema.SYSTEM(system))
         fd.Set(fd.Schema.OS_RELEASE(os_release))
@@ -247,7 +283,7 @@ class AFF4GRRTest(test_lib.AFF4ObjectTest):
         fd.Set(fd.Schema.USERNAMES([user]))
         fd.Set(fd.Schema.LAST_INTERFACES([interface]))
 
-      with aff4.FACTORY.Open("C.0000000000000000",
+      with aff4.FACTORY.Open(self.client_id,
                              aff4_grr.VFSGRRClient,
                              mode="rw",
                              token=self.token) as fd: